@@ -43,5 +43,8 @@ setup(
             "pre-commit~=2.12.1",
             "pylint~=2.8.2",
         ],
+        "orjson": [
+            "orjson~=3.5.2",
+        ],
     },
 )
@@ -1,16 +1,15 @@
 """Simple HTTP server to handle the OAuth2 redirect"""
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
-import threading
 from urllib.parse import urlparse, parse_qs
 
 
 class AuthHTTPRequestHandler(BaseHTTPRequestHandler):
     """Handler for OAuth callback"""
 
-    def _set_headers(self):
+    def _set_headers(self, status=200):
         """Set response headers"""
-        self.send_response(200)
+        self.send_response(status)
         self.send_header("Content-type", "text/html")
         self.end_headers()
 
@@ -18,13 +17,17 @@ class AuthHTTPRequestHandler(BaseHTTPRequestHandler):
         """Handle GET requests"""
         parsed_path = urlparse(self.path)
         query = parse_qs(parsed_path.query)
+        if "code" not in query:
+            # For example, the user denied access, or this is some other
+            # request, like for a favicon
+            self._set_headers(400)
+            self.wfile.write(bytes("missing authorization code", "utf-8"))
+            return
+
         authorization_code = query["code"][0]
         self.server.set_app_data("authorization_code", authorization_code)
         self._set_headers()
         self.wfile.write(bytes("received get request", "utf-8"))
-        # h/t
-        # https://stackoverflow.com/questions/19040055/how-do-i-shutdown-an-httpserver-from-inside-a-request-handler-in-python pylint: disable=line-too-long
-        threading.Thread(target=self.server.shutdown, daemon=True).start()
 
 
 class DataSavingHTTPServer(HTTPServer):
@@ -41,3 +44,7 @@ class DataSavingHTTPServer(HTTPServer):
     def get_app_data(self, key):
         """Retrieve a data element"""
         return self._app_data[key]
+
+    def has_app_data(self, key):
+        """Check whether a data element has been set"""
+        return key in self._app_data
@@ -1,34 +1,377 @@
 """Command-line interface"""
 
-from datetime import datetime
-from functools import partial
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from functools import lru_cache, partial
+from itertools import chain
 import json
 import os
 from pathlib import Path
-from random import randint
 import re
-import shutil
 import sqlite3
 import sys
-from time import sleep
+import threading
+from time import monotonic, sleep, time
+from urllib.parse import urlparse
 
 import click
-import fiona
-from playwright.sync_api import sync_playwright
+import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
-from shapely.geometry import shape
 from sqlite_utils import Database
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
 from strava_to_sqlite.auth_http_server import (
     AuthHTTPRequestHandler,
     DataSavingHTTPServer,
 )
 
+# Uses UPSERT syntax (https://www.sqlite.org/draft/lang_UPSERT.html),
+# available since 3.24.0.
+# See https://stackoverflow.com/questions/418898/sqlite-upsert-not-insert-or-replace
+#
+# Tracks are passed as a JSON array of {"id": ..., "ewkb": ...} objects that
+# is unnested with json_each() so a whole chunk of rows is inserted by one
+# statement.
+# The `WHERE true` is needed to avoid a parsing ambiguity when using UPSERT
+# with INSERT ... SELECT.
+INSERT_TRACK_SQL = """
+INSERT INTO activity_gpx_tracks (id, geometry)
+SELECT
+    json_extract(value, '$.id'),
+    GeomFromEWKB(json_extract(value, '$.ewkb'))
+FROM json_each(?)
+WHERE true
+ON CONFLICT(id) DO UPDATE SET geometry=excluded.geometry
+"""
+
+STRAVA_URL = "https://www.strava.com/"
+
+STRAVA_ACTIVITIES_URL = f"{STRAVA_URL}api/v3/athlete/activities"
+
+# Number of activities per page of API results. This is the maximum Strava
+# allows.
+ACTIVITIES_PER_PAGE = 200
+
+# Number of pages of activities to request from the Strava API at once
+MAX_CONCURRENT_PAGES = 4
+
+# Pause requests when this fraction of Strava's 15-minute rate limit is used
+RATE_LIMIT_THRESHOLD = 0.8
+
+# Length, in seconds, of Strava's short-term rate limit window
+RATE_LIMIT_WINDOW = 15 * 60
+
+# Print a message before waiting at least this many seconds for a rate limit
+RATE_LIMIT_NOTICE_SECONDS = 30
+
+# Number of keep-alive connections to hold open to the Strava API. This
+# should be at least MAX_CONCURRENT_PAGES.
+HTTP_POOL_SIZE = 8
+
+# Retry connection errors and server errors from Strava with backoff
+HTTP_RETRIES = Retry(
+    total=5,
+    backoff_factor=0.5,
+    # Rate limit (429) responses are handled by iter_activities(), which
+    # waits based on Strava's rate limit headers
+    status_forcelist=(500, 502, 503, 504),
+    # Let callers handle the final error response themselves
+    raise_on_status=False,
+)
+
+STRAVA_DASHBOARD_URL = "https://www.strava.com/dashboard"
+
+# Number of GPX files to download at once
+GPX_DOWNLOAD_WORKERS = 4
+
+# (connect, read) timeouts, in seconds, for GPX downloads
+GPX_DOWNLOAD_TIMEOUT = (10, 30)
+
+# Strava's documented (window in seconds, request limit) rate limits. The
+# website's GPX export doesn't report rate limit usage like the API does, so
+# we count downloads against these ourselves.
+GPX_DOWNLOAD_RATE_LIMITS = (
+    (RATE_LIMIT_WINDOW, 100),
+    (24 * 60 * 60, 1000),
+)
+
+# Parse GPX files in a pool of processes when loading at least this many
+GPX_PROCESS_POOL_MIN_FILES = 8
+
+# Number of GPX tracks to insert with each statement. This keeps the JSON
+# payload well under SQLite's maximum string length.
+GPX_TRACKS_PER_INSERT = 500
+
+# Patterns used to build filename slugs
+SLUG_SPECIAL_CHARS_RE = re.compile(r"[#'\",\-]")
+SLUG_WHITESPACE_RE = re.compile(r"\s+")
+
+# Table that activities are loaded into before replacing the ones in the
+# activities table
+ACTIVITIES_STAGING_TABLE = "_activities_staging"
+
+# PRAGMAs that speed up bulk loading data. In WAL mode, synchronous=NORMAL
+# only syncs at checkpoints, while still keeping the database consistent.
+# See https://www.sqlite.org/pragma.html
+BULK_LOAD_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-131072",
+    "mmap_size=268435456",
+)
+
+
+def set_bulk_load_pragmas(con):
+    """Tune a SQLite connection for bulk inserts"""
+    for pragma in BULK_LOAD_PRAGMAS:
+        con.execute(f"PRAGMA {pragma}")
+
+
+def rate_limit_usage(resp):
+    """Get Strava's rate limit usage from an API response
+
+    Returns a list of (usage, limit) tuples for the 15-minute and daily
+    windows, or an empty list if the response doesn't include rate limit
+    headers.
+    See https://developers.strava.com/docs/rate-limits/
+    """
+    try:
+        usage = resp.headers["X-RateLimit-Usage"].split(",")
+        limits = resp.headers["X-RateLimit-Limit"].split(",")
+        return [(int(used), int(limit)) for used, limit in zip(usage, limits)]
+    except (KeyError, ValueError):
+        return []
+
+
+def rate_limit_pause(resp):
+    """Get the number of seconds to wait before making more API requests
+
+    Returns 0 if there's plenty of room left in the 15-minute window and None
+    if the daily limit has been reached. Otherwise, the remaining requests are
+    spread evenly over the rest of the window, like a token bucket.
+    """
+    usage = rate_limit_usage(resp)
+    if usage and usage[-1][0] >= usage[-1][1]:
+        return None
+
+    retry_after = resp.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return int(retry_after)
+
+    if not usage:
+        return 0
+
+    used, limit = usage[0]
+    if used < limit * RATE_LIMIT_THRESHOLD:
+        return 0
+
+    # The 15-minute window resets at natural 15-minute boundaries
+    window_left = RATE_LIMIT_WINDOW - time() % RATE_LIMIT_WINDOW
+    if used >= limit:
+        return window_left
+
+    return window_left / (limit - used)
+
+
+def rate_limit_sleep(seconds):
+    """Wait for Strava's rate limit, letting the user know about long waits"""
+    if seconds >= RATE_LIMIT_NOTICE_SECONDS:
+        sys.stderr.write(
+            f"Waiting {seconds / 60:.1f} minutes for Strava's rate limit\n"
+        )
+
+    sleep(seconds)
+
+
+class DownloadPacer:  # pylint: disable=too-few-public-methods
+    """Pace requests from multiple threads to stay within rate limits
+
+    Waits of up to Strava's 15-minute window are slept through. Once a
+    longer wait would be needed, such as for the daily limit, `limit_reached`
+    is set and no more requests are allowed.
+    """
+
+    def __init__(self, limits=GPX_DOWNLOAD_RATE_LIMITS):
+        self._limits = limits
+        self._longest_window = max(window for window, _ in limits)
+        self._request_times = deque()
+        self._lock = threading.Lock()
+        self.limit_reached = False
+
+    def wait(self):
+        """Block until another request can be made without exceeding the limits
+
+        Returns False if the limits don't allow another request within the
+        15-minute window.
+        """
+        with self._lock:
+            while True:
+                if self.limit_reached:
+                    return False
+
+                now = monotonic()
+                while (
+                    self._request_times
+                    and now - self._request_times[0] >= self._longest_window
+                ):
+                    self._request_times.popleft()
+
+                pause = 0
+                for window, limit in self._limits:
+                    recent = [t for t in self._request_times if now - t < window]
+                    if len(recent) >= limit:
+                        pause = max(pause, recent[0] + window - now)
+
+                if pause <= 0:
+                    self._request_times.append(now)
+                    return True
+
+                if pause > RATE_LIMIT_WINDOW:
+                    self.limit_reached = True
+                    return False
+
+                rate_limit_sleep(pause)
+
+
+def fetch_activities_page(client, params, page):
+    """Request a single page of the authenticated athlete's activities"""
+    return client.get(
+        STRAVA_ACTIVITIES_URL,
+        params={**params, "page": page, "per_page": ACTIVITIES_PER_PAGE},
+    )
+
+
+def iter_activities(client, params):
+    """Yield the authenticated athlete's activities from the Strava API
+
+    Pages are requested concurrently, while staying within Strava's rate
+    limits.
+    """
+    fetch_page = partial(fetch_activities_page, client, params)
+    # Start with a single page, since incremental loads often only need one
+    concurrency = 1
+    page = 1
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PAGES) as executor:
+        while True:
+            pages = range(page, page + concurrency)
+            page = pages.stop
+            pause = 0
+            for page_num, resp in zip(pages, executor.map(fetch_page, pages)):
+                if resp.status_code == 429:
+                    pause = rate_limit_pause(resp)
+                    if pause:
+                        # Wait for the limit to reset, then retry this page
+                        page = page_num
+                        break
+
+                if resp.status_code != 200:
+                    if resp.status_code == 429:
+                        sys.stderr.write("Request limit reached\n")
+
+                    return
+
+                activities_page = json_loads(resp.content)
+                yield from activities_page
+
+                # A page that isn't full is the last one, so we don't need to
+                # request another page just to find that it's empty.
+                if len(activities_page) < ACTIVITIES_PER_PAGE:
+                    return
+
+                # Only pause when we're close to Strava's rate limit, and
+                # only request as many pages at once as we have headroom for.
+                pause = rate_limit_pause(resp)
+                if pause is None:
+                    sys.stderr.write("Request limit reached\n")
+                    return
+
+                concurrency = MAX_CONCURRENT_PAGES
+                usage = rate_limit_usage(resp)
+                if usage:
+                    headroom = min(limit - used for used, limit in usage)
+                    concurrency = max(1, min(concurrency, headroom))
+
+                if pause:
+                    # The pause spaces out single requests, so stop making
+                    # concurrent ones once we're pacing ourselves.
+                    concurrency = 1
+
+            if pause:
+                rate_limit_sleep(pause)
+
+
+def json_loads(data):
+    """Deserialize JSON from a str or bytes, using orjson if it's installed"""
+    if orjson is not None:
+        return orjson.loads(data)  # pylint: disable=no-member
+
+    return json.loads(data)
+
+
+def json_dumps(obj):
+    """Serialize an object to a JSON-encoded bytes, using orjson if it's installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)  # pylint: disable=no-member
+
+    return json.dumps(obj).encode("utf-8")
+
+
+def load_token(json_path):
+    """Load an OAuth token from a JSON file"""
+    return json_loads(Path(json_path).read_bytes())
+
 
 def save_token(token, json_path):
-    """Save an OAuth token to a JSON file"""
-    with open(json_path, "w") as outf:
-        outf.write(json.dumps(token))
+    """Save an OAuth token to a JSON file
+
+    The token is written right away, since Strava invalidates the old
+    refresh token when it issues a new one.
+    """
+    with open(json_path, "wb") as outf:
+        outf.write(json_dumps(token))
+
+
+@lru_cache(maxsize=None)
+def get_strava_client(auth_path):
+    """Get an authenticated Strava API client
+
+    Clients are cached per token file so that every Strava request in the
+    process reuses the same pool of keep-alive connections.
+    """
+    client_id = os.environ["STRAVA_CLIENT_ID"]
+
+    # See https://requests-oauthlib.readthedocs.io/en/latest/oauth2_workflow.html
+    # and https://developers.strava.com/docs/authentication/#refreshingexpiredaccesstokens
+    client = OAuth2Session(
+        client_id,
+        token=load_token(auth_path),
+        auto_refresh_url="https://www.strava.com/oauth/token",
+        auto_refresh_kwargs={
+            "client_id": client_id,
+            "client_secret": os.environ["STRAVA_CLIENT_SECRET"],
+        },
+        token_updater=partial(save_token, json_path=auth_path),
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=HTTP_RETRIES,
+    )
+    client.mount(STRAVA_URL, adapter)
+
+    return client
 
 
 @click.group()
@@ -65,7 +408,12 @@ def auth(auth):  # pylint: disable=redefined-outer-name
     host = ""
     port = 8080
     server = DataSavingHTTPServer((host, port), AuthHTTPRequestHandler)
-    server.serve_forever()
+    # Handle requests until we get the OAuth redirect with the authorization
+    # code
+    while not server.has_app_data("authorization_code"):
+        server.handle_request()
+
+    server.server_close()
     # Get an access token
     # See https://requests-oauthlib.readthedocs.io/en/latest/oauth2_workflow.html#web-application-flow pylint: disable=line-too-long
     # See also https://developers.strava.com/docs/getting-started/
@@ -112,75 +460,75 @@ def activities(
     db_path, auth, all_activities=False, truncate=False
 ):  # pylint: disable=redefined-outer-name
     """Fetch activities feed"""
-    client_id = os.environ["STRAVA_CLIENT_ID"]
-
-    with open(auth) as f:  # pylint: disable=invalid-name
-        token = json.load(f)
-
-    # See https://requests-oauthlib.readthedocs.io/en/latest/oauth2_workflow.html
-    # and https://developers.strava.com/docs/authentication/#refreshingexpiredaccesstokens
-    client = OAuth2Session(
-        client_id,
-        token=token,
-        auto_refresh_url="https://www.strava.com/oauth/token",
-        auto_refresh_kwargs={
-            "client_id": client_id,
-            "client_secret": os.environ["STRAVA_CLIENT_SECRET"],
-        },
-        token_updater=partial(save_token, json_path=auth),
-    )
+    client = get_strava_client(auth)
 
     db = Database(db_path)  # pylint: disable=invalid-name
+    set_bulk_load_pragmas(db.conn)
 
-    try:
-        max_start_date = list(
-            db["activities"].rows_where(select="MAX(start_date) AS max_start_date")
-        )[0]["max_start_date"]
-        max_start_date = datetime(
-            int(max_start_date[:4]),
-            int(max_start_date[5:7]),
-            int(max_start_date[8:10]),
-            int(max_start_date[11:13]),
-            int(max_start_date[14:16]),
-            int(max_start_date[17:19]),
-        )
-
-    except IndexError:
-        max_start_date = None
+    max_start_ts = None
+    if db["activities"].exists():
+        # Have SQLite convert the ISO 8601 UTC start date to a Unix timestamp
+        # rather than parsing it ourselves.
+        max_start_ts = db.execute(
+            "SELECT CAST(strftime('%s', MAX(start_date)) AS INTEGER) FROM activities"
+        ).fetchone()[0]
 
     params = {}
-    if not (all_activities or max_start_date is None):
+    if not (all_activities or max_start_ts is None):
         # User has not set the --all-activities flag and there are some
         # existing records. Only fetch activities since the latest activity.
         params = {
-            "after": int(max_start_date.timestamp()),
+            "after": max_start_ts,
         }
 
-    activities = []  # pylint: disable=redefined-outer-name
-    page = 1
-    while True:
-        params["page"] = page
-        resp = client.get(
-            "https://www.strava.com/api/v3/athlete/activities", params=params
-        )
+    # Stream activities into a staging table in batches as pages are fetched,
+    # rather than holding every activity in memory. sqlite-utils commits each
+    # batch, so writing straight to the activities table would leave it
+    # truncated or only partly loaded if the load is interrupted. Allow adding
+    # columns since later batches may have fields that earlier ones didn't.
+    db.execute(f"DROP TABLE IF EXISTS {ACTIVITIES_STAGING_TABLE}")
+    db[ACTIVITIES_STAGING_TABLE].insert_all(  # pylint: disable=no-member
+        iter_activities(client, params),
+        pk="id",
+        replace=True,
+        alter=True,
+        batch_size=1000,
+    )
+
+    if db[ACTIVITIES_STAGING_TABLE].exists():
+        replace_staged_activities(db, truncate=truncate)
+
 
-        if resp.status_code != 200:
-            if resp.status_code == 429:
-                sys.stderr.write("Request limit reached\n")
+def replace_staged_activities(db, truncate=False):  # pylint: disable=invalid-name
+    """Move activities from the staging table into the activities table
+
+    This happens in a single transaction, so an interrupted load never leaves
+    a truncated table, or newer activities without the older ones, which
+    later incremental loads would skip.
+    """
+    if not db["activities"].exists():
+        db.execute(f"ALTER TABLE {ACTIVITIES_STAGING_TABLE} RENAME TO activities")
+        return
 
-            break
+    db.conn.execute("BEGIN IMMEDIATE")
 
-        activities_page = resp.json()
-        if len(activities_page) == 0:
-            break
+    existing_columns = {col.name for col in db["activities"].columns}
+    staged_columns = db[ACTIVITIES_STAGING_TABLE].columns
+    for col in staged_columns:
+        if col.name not in existing_columns:
+            db.execute(f"ALTER TABLE activities ADD COLUMN [{col.name}] {col.type}")
 
-        activities += activities_page
-        page += 1
-        sleep(1)
+    if truncate:
+        db.execute("DELETE FROM activities")
 
-    db["activities"].insert_all(  # pylint: disable=no-member
-        activities, pk="id", replace=True, truncate=truncate
+    column_list = ", ".join(f"[{col.name}]" for col in staged_columns)
+    db.execute(
+        f"INSERT OR REPLACE INTO activities ({column_list}) "
+        f"SELECT {column_list} FROM {ACTIVITIES_STAGING_TABLE}"
     )
+    db.execute(f"DROP TABLE {ACTIVITIES_STAGING_TABLE}")
+
+    db.conn.commit()
 
 
 def slugify(val, sep="_"):
@@ -189,10 +537,10 @@ def slugify(val, sep="_"):
     slugified = val.lower()
 
     # Remove special characters
-    slugified = re.sub(r"[#'\",\-]", "", slugified)
+    slugified = SLUG_SPECIAL_CHARS_RE.sub("", slugified)
 
     # Replace whitespace with separator and remove repeated whitespace
-    slugified = re.sub(r"\s+", sep, slugified)
+    slugified = SLUG_WHITESPACE_RE.sub(sep, slugified)
 
     return slugified
 
@@ -205,23 +553,8 @@ def gpx_filename(activity):
     return f"{activity_date_slug}_{activity['id']}_{slugify(activity['name'])}.gpx"
 
 
-def download_gpx(  # pylint: disable=too-many-arguments
-    playwright,
-    activities,  # pylint: disable=redefined-outer-name
-    username,
-    password,
-    user_data_dir,
-    gpx_dir,
-):
-    """Use playwright to download a GPX file"""
-    context = playwright.chromium.launch_persistent_context(
-        user_data_dir,
-        headless=False,
-        accept_downloads=True,
-    )
-    # Open new page
-    page = context.new_page()
-
+def log_in(page, username, password):
+    """Log in to Strava in a Playwright page"""
     # Go to https://www.strava.com/
     page.goto("https://www.strava.com/")
 
@@ -247,60 +580,250 @@ def download_gpx(  # pylint: disable=too-many-arguments
     page.click('button:has-text("Log In")')
     # assert page.url == "https://www.strava.com/dashboard"
 
-    activity_gpx_info = []
 
-    for activity in activities:
-        gpx_path = gpx_dir / gpx_filename(activity)
+def get_session_cookies(username, password, storage_state_path, headless=True):
+    """Use playwright to log in to the Strava website and get session cookies"""
+    # Playwright is slow to import, so only import it when needed
+    from playwright.sync_api import (  # pylint: disable=import-outside-toplevel
+        sync_playwright,
+    )
 
-        # TODO: Support forcing the re-download of the activity pylint: disable=fixme
-        if gpx_path.exists():
-            # Don't re-download a GPX file that already exists
-            activity_gpx_info.append((activity["id"], gpx_path))
-            continue
+    with sync_playwright() as playwright:
+        browser = playwright.chromium.launch(headless=headless)
 
-        # Go to page for activities
-        page.goto(f"https://www.strava.com/activities/{activity['id']}")
+        # The session cookies are saved between runs, so only log in if
+        # Strava sends us away from the dashboard.
+        context = browser.new_context(
+            storage_state=storage_state_path if storage_state_path.exists() else None
+        )
+        page = context.new_page()
+        page.goto(STRAVA_DASHBOARD_URL)
+        if not page.url.startswith(STRAVA_DASHBOARD_URL):
+            log_in(page, username, password)
 
-        # Click [aria-label="Actions"]
-        page.click('[aria-label="Actions"]')
+            # Make sure the login worked, otherwise every download would just
+            # be redirected to the login page.
+            page.goto(STRAVA_DASHBOARD_URL)
+            if not page.url.startswith(STRAVA_DASHBOARD_URL):
+                browser.close()
+                raise click.ClickException(
+                    "Could not log in to Strava. Check STRAVA_USERNAME and "
+                    "STRAVA_PASSWORD."
+                )
 
-        if page.query_selector("text=Export GPX") is None:
-            # Some activities don't have tracks associated with them
-            continue
+        context.storage_state(path=storage_state_path)
+        cookies = context.cookies()
 
-        # Click text=Export GPX
-        with page.expect_download() as download_info:
-            page.click("text=Export GPX")
+        browser.close()
 
-        download = download_info.value
-        path = download.path()
+    return cookies
 
-        shutil.copyfile(path, gpx_path)
-        activity_gpx_info.append((activity["id"], gpx_path))
 
-        sleep(randint(1, 5))
+def download_activity_gpx(session, pacer, activity, gpx_dir, existing_filenames):
+    """Download the GPX file for an activity
 
-    context.close()
+    `existing_filenames` is a set of the names of files already in `gpx_dir`.
+    Returns an (activity ID, GPX path) tuple, or None if the activity doesn't
+    have a GPX track or Strava's rate limit has been reached.
+    """
+    filename = gpx_filename(activity)
+    gpx_path = gpx_dir / filename
+
+    # TODO: Support forcing the re-download of the activity pylint: disable=fixme
+    if filename in existing_filenames:
+        # Don't re-download a GPX file that already exists
+        return activity["id"], gpx_path
+
+    # Only wait when we're about to hit Strava's rate limits
+    if not pacer.wait():
+        return None
+
+    # This is the URL behind the "Export GPX" action on the activity page
+    activity_url = f"{STRAVA_URL}activities/{activity['id']}"
+    resp = session.get(
+        f"{activity_url}/export_gpx", stream=True, timeout=GPX_DOWNLOAD_TIMEOUT
+    )
+    with resp:
+        if urlparse(resp.url).path.startswith("/login"):
+            raise click.ClickException(
+                "Strava redirected the GPX download to the login page. "
+                "The saved login may have expired."
+            )
+
+        if "attachment" not in resp.headers.get("Content-Disposition", ""):
+            if resp.status_code == 200 and resp.url.rstrip("/") == activity_url:
+                # Some activities don't have tracks associated with them, in
+                # which case Strava sends us back to the activity page
+                return None
+
+            raise click.ClickException(
+                f"Could not download GPX for activity {activity['id']}: "
+                f"HTTP {resp.status_code} from {resp.url}"
+            )
+
+        # Write to a temporary file in the same directory and then rename it,
+        # which doesn't copy any data, so an interrupted download never
+        # leaves a partial file that would be mistaken for a cached one.
+        partial_path = gpx_path.with_suffix(".gpx.part")
+        with open(partial_path, "wb") as outf:
+            for chunk in resp.iter_content(chunk_size=64 * 1024):
+                outf.write(chunk)
+
+        os.replace(partial_path, gpx_path)
+
+    return activity["id"], gpx_path
+
+
+def get_gpx_session(username, password, storage_state_path, headless=True):
+    """Get a requests session with the Strava website's session cookies
+
+    Playwright is only used to log in and get the cookies.
+    """
+    cookies = get_session_cookies(username, password, storage_state_path, headless)
+
+    session = requests.Session()
+    session.mount(
+        STRAVA_URL,
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=GPX_DOWNLOAD_WORKERS,
+            max_retries=HTTP_RETRIES,
+        ),
+    )
+    for cookie in cookies:
+        session.cookies.set(
+            cookie["name"],
+            cookie["value"],
+            domain=cookie["domain"],
+            path=cookie["path"],
+        )
+
+    return session
+
+
+def list_filenames(dir_path):
+    """Get a set of the names of the files in a directory"""
+    with os.scandir(dir_path) as entries:
+        return {entry.name for entry in entries}
+
+
+def download_gpx(  # pylint: disable=too-many-arguments
+    activities,  # pylint: disable=redefined-outer-name
+    username,
+    password,
+    storage_state_path,
+    gpx_dir,
+    headless=True,
+):
+    """Download GPX files for activities
+
+    The files are downloaded directly, GPX_DOWNLOAD_WORKERS at a time, using
+    the session cookies from logging in to the website.
+    """
+    pacer = DownloadPacer()
+    download = partial(
+        download_activity_gpx,
+        get_gpx_session(username, password, storage_state_path, headless),
+        pacer,
+        gpx_dir=gpx_dir,
+        # List the cached files once rather than checking for each activity's
+        # file
+        existing_filenames=list_filenames(gpx_dir),
+    )
+    activity_gpx_info = []
+    pending = set()
+
+    def collect(futures):
+        for future in futures:
+            result = future.result()
+            if result is not None:
+                activity_gpx_info.append(result)
+
+    # Submit downloads as activities are read, keeping only a few in flight,
+    # rather than using `executor.map()`, which would read all the activities
+    # up front.
+    with ThreadPoolExecutor(max_workers=GPX_DOWNLOAD_WORKERS) as executor:
+        for activity in activities:
+            if pacer.limit_reached:
+                # Load the files we have rather than waiting most of a day
+                # for the daily limit to reset
+                break
+
+            if len(pending) >= GPX_DOWNLOAD_WORKERS * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            pending.add(executor.submit(download, activity))
+
+        collect(wait(pending).done)
+
+    if pacer.limit_reached:
+        sys.stderr.write("Request limit reached\n")
 
     return activity_gpx_info
 
 
-def activity_tuples_to_dict(activities_raw):
-    """Convert activity tuples to dictionary"""
-    # HACK: This converts them manually.
-    # It might be better to hook into SQLite to do this instead.
-    # See https://stackoverflow.com/questions/3300464/how-can-i-get-dict-from-sqlite-query
-    activities = []  # pylint: disable=redefined-outer-name
-    for activity_id, name, start_date_local in activities_raw:
-        activities.append(
-            {
-                "id": activity_id,
-                "name": name,
-                "start_date_local": start_date_local,
-            }
+def select_gpx_activities(database, activity_id, all_activities):
+    """Select the activities to download GPX files for
+
+    Returns an iterator of rows with `id`, `name` and `start_date_local`
+    columns.
+    """
+    if len(activity_id) != 0:
+        # User specified explicit activity IDs
+
+        # Load the IDs into a temporary table and join against it rather
+        # than building an `IN (?, ?, ...)` clause, which would run into
+        # SQLite's limit on the number of query variables for long lists.
+        # The connection is cached and may be reused within this process, so
+        # the table may already exist from an earlier call.
+        database.conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS selected_activity_ids "
+            "(id INTEGER PRIMARY KEY)"
+        )
+        database.conn.execute("DELETE FROM selected_activity_ids")
+        database.conn.executemany(
+            "INSERT OR IGNORE INTO selected_activity_ids VALUES (?)",
+            [(i,) for i in activity_id],
         )
+        database.conn.commit()
+
+        selected_activities_sql = """
+        SELECT
+            id,
+            name,
+            start_date_local
+        FROM activities
+        JOIN selected_activity_ids USING (id)
+        """
+        cur = database.conn.cursor()
+        cur.row_factory = sqlite3.Row
+        return cur.execute(selected_activities_sql)
 
-    return activities
+    if all_activities:
+        # Download GPX for all activities.
+        # Stream the rows rather than loading every activity into memory.
+        return database["activities"].rows_where(select="id, name, start_date_local")
+
+    # Download only GPX files that don't have a record in the
+    # GPX table.
+    undownloaded_gpx_sql = """
+    SELECT
+        id,
+        name,
+        start_date_local
+    FROM activities
+    WHERE 
+        -- Use this to filter out activities that don't have GPS data
+        start_latitude IS NOT NULL
+        -- Use this to filter out already loaded GPX tracks
+        AND id NOT IN (SELECT id FROM activity_gpx_tracks)
+    """
+    # Return rows that can be accessed by column name like the dicts
+    # returned by `rows_where()`
+    cur = database.conn.cursor()
+    cur.row_factory = sqlite3.Row
+    return cur.execute(undownloaded_gpx_sql)
 
 
 @cli.command()
@@ -333,11 +856,17 @@ def activity_tuples_to_dict(activities_raw):
         "loads ones that haven't been loaded"
     ),
 )
+@click.option(
+    "--headless/--no-headless",
+    default=True,
+    help="Run the browser used to download GPX files in headless mode",
+)
 def activity_gpx(
     db_path,
     cache_dir,
     activity_id=None,
     all_activities=False,
+    headless=True,
 ):
     """Download GPX for an activity or all activities."""
     if activity_id is None:
@@ -347,69 +876,37 @@ def activity_gpx(
     strava_password = os.environ["STRAVA_PASSWORD"]
 
     cache_dir = Path(cache_dir)
-    user_data_dir = cache_dir / "playwright_user_data"
+    storage_state_path = cache_dir / "playwright_storage_state.json"
     gpx_dir = cache_dir / "gpx"
-    os.makedirs(user_data_dir, exist_ok=True)
     os.makedirs(gpx_dir, exist_ok=True)
 
-    db = Database(db_path)  # pylint: disable=invalid-name
+    # Use the same connection that load_activity_gpx_tracks() will use to
+    # load the tracks, rather than opening a second one. This also makes
+    # sure the GPX table exists before we query it.
+    db = Database(get_spatialite_connection(db_path))  # pylint: disable=invalid-name
 
-    if len(activity_id) != 0:
-        # User specified explicit activity IDs
-
-        # HACK: AFAIK Python SQLite parameter replacement only supports
-        # individual values, so since we have a list of IDs, we need to
-        # build up the placeholder string based on the number of values
-        # in our list of activity IDs. I think this is relatively safe
-        # since we're not using string interpolation to insert values
-        # into the SQL, just a certain number of `?` placeholders.
-        in_placeholder = ", ".join(["?" for i in range(len(activity_id))])
-        activities = list(  # pylint: disable=redefined-outer-name
-            db["activities"].rows_where(
-                f"id IN ({in_placeholder})",
-                activity_id,
-                select="id, name, start_date_local",
-            )
-        )
-
-    elif all_activities:
-        # Download GPX for all activities.
-        activities = list(
-            db["activities"].rows_where(select="id, name, start_date_local")
-        )
-
-    else:
-        # Download only GPX files that don't have a record in the
-        # GPX table.
-        undownloaded_gpx_sql = """
-        SELECT
-            id,
-            name,
-            start_date_local
-        FROM activities
-        WHERE 
-            -- Use this to filter out activities that don't have GPS data
-            start_latitude IS NOT NULL
-            -- Use this to filter out already loaded GPX tracks
-            AND id NOT IN (SELECT id FROM activity_gpx_tracks)
-        """
-        activities = activity_tuples_to_dict(
-            db.execute(undownloaded_gpx_sql).fetchall()
-        )
+    activities = select_gpx_activities(  # pylint: disable=redefined-outer-name
+        db, activity_id, all_activities
+    )
 
-    if len(activities) == 0:
+    # Peek at the first activity so we can avoid launching a browser when
+    # there's nothing to fetch, without consuming the rest of the rows.
+    activities = iter(activities)
+    first_activity = next(activities, None)
+    if first_activity is None:
         # No activitiy GPX to fetch
         return
 
-    with sync_playwright() as playwright:
-        activity_gpx_paths = download_gpx(
-            playwright,
-            activities,
-            strava_username,
-            strava_password,
-            user_data_dir,
-            gpx_dir,
-        )
+    activities = chain([first_activity], activities)
+
+    activity_gpx_paths = download_gpx(
+        activities,
+        strava_username,
+        strava_password,
+        storage_state_path,
+        gpx_dir,
+        headless=headless,
+    )
 
     load_activity_gpx_tracks(activity_gpx_paths, db_path)
 
@@ -417,16 +914,31 @@ def activity_gpx(
 def init_gpx_table(con):
     """Initialize spatial metadata and table for GPX data"""
     cur = con.cursor()
+
+    # Record that the table has been initialized so later runs can skip
+    # checking the spatial metadata and schema.
+    create_meta_table_sql = """
+    CREATE TABLE IF NOT EXISTS _strava_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+    cur.execute(create_meta_table_sql)
+    cur.execute("SELECT value FROM _strava_meta WHERE key='gpx_initialized'")
+    if cur.fetchone() is not None:
+        return
+
     # Initialize spatial metadata.
     meta_table_exists_sql = """
-    SELECT count(name)
+    SELECT 1
     FROM sqlite_master
     WHERE
       type='table'
       AND name='spatial_ref_sys'
+    LIMIT 1
     """
     cur.execute(meta_table_exists_sql)
-    if cur.fetchone()[0] != 1:
+    if cur.fetchone() is None:
         init_spatial_meta_sql = "SELECT InitSpatialMetaData();"
         cur.execute(init_spatial_meta_sql)
 
@@ -438,9 +950,14 @@ def init_gpx_table(con):
     """
     cur.execute(create_table_sql)
 
-    result = cur.execute("PRAGMA table_info(activity_gpx_tracks)")
-    colnames = [x[1] for x in result]
-    if "geometry" not in colnames:
+    geometry_column_exists_sql = """
+    SELECT 1
+    FROM pragma_table_info('activity_gpx_tracks')
+    WHERE name='geometry'
+    LIMIT 1
+    """
+    cur.execute(geometry_column_exists_sql)
+    if cur.fetchone() is None:
         add_spatial_column_sql = """
         SELECT AddGeometryColumn(
             'activity_gpx_tracks',
@@ -451,47 +968,87 @@ def init_gpx_table(con):
         """
         cur.execute(add_spatial_column_sql)
 
+    cur.execute("INSERT INTO _strava_meta VALUES ('gpx_initialized', '1')")
     con.commit()
 
 
-def load_activity_gpx_tracks(activity_gpx_info, db_path):
-    """Load activity GPX tracks into the SQLite database"""
+def gpx_track_ewkb(activity_gpx_path):
+    """Get the hex-encoded EWKB for the track in an activity's GPX file
+
+    Takes an (activity ID, GPX path) tuple and returns an
+    (activity ID, EWKB) tuple.
+    """
+    # Fiona and Shapely are slow to import, so only import them when needed
+    import fiona  # pylint: disable=import-outside-toplevel
+    from shapely import wkb  # pylint: disable=import-outside-toplevel
+    from shapely.geometry import shape  # pylint: disable=import-outside-toplevel
+
+    activity_id, gpx_path = activity_gpx_path
+    # There are some spatialite functions for working with GPX data, but
+    # I couldn't get the libxml2 module working for Ubuntu 20.04.
+    # To see how to use these functions, see
+    # https://www.gaia-gis.it/fossil/libspatialite/wiki?name=GPX+tracks.
+    # This might be an easier approach when they're more widely supported.
+    #
+    # Instead, we'll use Fiona and Shapely to load the GPX file and get
+    # a geometry we can insert into Spatialite.
+    # See https://ocefpaf.github.io/python4oceanographers/blog/2015/08/03/fiona_gpx/
+    with fiona.open(gpx_path, layer="tracks") as tracks:
+        # The tracks layer geometry is already a MultiLineString, so
+        # build the shape from it directly.
+        shp = shape(tracks[0]["geometry"])
+
+    # Binary geometries are quicker to write and parse than WKT. Since
+    # they're passed to SQLite in JSON, use the hex-encoded, PostGIS flavored
+    # EWKB that Spatialite's GeomFromEWKB() reads, which also carries the
+    # SRID. Hex encoding doubles the size of the binary geometry, which is
+    # why tracks are inserted GPX_TRACKS_PER_INSERT at a time.
+    return activity_id, wkb.dumps(shp, hex=True, srid=4326)
+
+
+@lru_cache(maxsize=None)
+def get_spatialite_connection(db_path):
+    """Get a connection to a database with Spatialite loaded
+
+    Connections are cached per database path so loading the extension and
+    initializing the GPX table only happens once per process.
+    """
     con = sqlite3.connect(db_path)
     con.enable_load_extension(True)
     con.load_extension("mod_spatialite")
+    set_bulk_load_pragmas(con)
 
     init_gpx_table(con)
 
-    cur = con.cursor()
+    return con
 
-    for activity_id, gpx_path in activity_gpx_info:
-        # There are some spatialite functions for working with GPX data, but
-        # I couldn't get the libxml2 module working for Ubuntu 20.04.
-        # To see how to use these functions, see
-        # https://www.gaia-gis.it/fossil/libspatialite/wiki?name=GPX+tracks.
-        # This might be an easier approach when they're more widely supported.
-        #
-        # Instead, we'll use Fiona and Shapely to load the GPX file and get
-        # the WKT we can insert into Spatialite.
-        # See https://ocefpaf.github.io/python4oceanographers/blog/2015/08/03/fiona_gpx/
-        tracks = fiona.open(gpx_path, layer="tracks")
-        geom = tracks[0]
-        shp = shape(
-            {
-                "type": "MultiLineString",
-                "coordinates": geom["geometry"]["coordinates"],
-            }
-        )
 
-        # Uses UPSERT syntax (https://www.sqlite.org/draft/lang_UPSERT.html),
-        # available since 3.24.0.
-        # See https://stackoverflow.com/questions/418898/sqlite-upsert-not-insert-or-replace
-        insert_track_sql = """
-        INSERT INTO activity_gpx_tracks
-        VALUES (?, MultiLineStringFromText(?, 4326))
-        ON CONFLICT(id) DO UPDATE SET geometry=excluded.geometry
-        """
-        cur.execute(insert_track_sql, (activity_id, shp.wkt))
+def load_activity_gpx_tracks(activity_gpx_info, db_path):
+    """Load activity GPX tracks into the SQLite database"""
+    con = get_spatialite_connection(db_path)
+
+    # Parsing the GPX files and building the geometries is CPU-bound and
+    # independent for each file, so do it in parallel across processes.
+    # Only the database writes need to be serialized. Each worker has to
+    # import Fiona and GDAL itself, so that's only worth it for more than a
+    # few files.
+    if len(activity_gpx_info) < GPX_PROCESS_POOL_MIN_FILES:
+        rows = list(map(gpx_track_ewkb, activity_gpx_info))
+    else:
+        max_workers = min(os.cpu_count() or 1, len(activity_gpx_info))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            rows = list(executor.map(gpx_track_ewkb, activity_gpx_info, chunksize=8))
+
+    # Insert the tracks in chunks with one statement each, rather than paying
+    # the statement and commit overhead for each file, and commit them all
+    # at once. Take the write lock up front so the transaction can't fail
+    # partway through waiting to upgrade from a read lock.
+    con.execute("BEGIN IMMEDIATE")
+    for start in range(0, len(rows), GPX_TRACKS_PER_INSERT):
+        chunk = rows[start : start + GPX_TRACKS_PER_INSERT]
+        # Bind the payload as text, since SQLite's JSON functions reject blobs
+        payload = json_dumps([{"id": aid, "ewkb": ewkb} for aid, ewkb in chunk])
+        con.execute(INSERT_TRACK_SQL, (payload.decode("utf-8"),))
 
     con.commit()
 